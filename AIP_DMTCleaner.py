@@ -19,6 +19,17 @@ Arguments:
 2. archive - Use this argutment to purge deliveries, instead of deleting them.
 3. app  - Use this argument to drop deliveries for a specific application. By default, the action is performed for all apps.
 4. cut_date - Only deliveries older than this date will be deleted.
+5. trash - Move the version folder into the .trash folder before calling the CLI. The folder is physically
+           deleted later by a background reaper, once the grace period set in the YAML file has expired.
+           Cannot be used with -archive or -cas_archive.
+6. restore - Move the files of a trashed version to the folder given with -restore_to, using the trash id logged
+             when it was trashed. The folder must be outside the delivery folder, since the deleted version
+             is not registered in DMT again.
+7. cas_archive - Purge deliveries like -archive, but first store the version source in the deduplicated archive store,
+                 so it can be restored later.
+8. restore_version - Restore an archived version source, for the application given with -app.
+9. forget_version - Remove an archived version from the archive store, for the application given with -app.
+10. archive_gc - Delete archive store chunks no longer used by any archived version.
 
 NOTE:
 """
@@ -42,6 +53,8 @@ from subprocess import PIPE, STDOUT, DEVNULL, run, CalledProcessError
 
 import DMTInfo as DMT
 import VerInfo as Ver
+import Trash
+import ArchiveStore as Store
 
 # Logger settings.
 logger = logging.getLogger(__name__)
@@ -59,6 +72,16 @@ password = ''
 CAST_HOME = ''
 
 archive_delivery = False
+trash_delivery = False
+restore_id = ''
+restore_to = ''
+trash_bin = None
+
+cas_archive = False
+archive_gc = False
+restore_version = ''
+forget_version = ''
+archive_store = None
 
 apps = []
 connection_profiles = []
@@ -342,6 +365,101 @@ def get_prev_version(ver_entity_file):
 
     return has_prev_ver
 
+def init_trash():
+    """
+    Sets up the trash bin. The trash folder must be on the same volume as the delivery folder,
+    so that moving a version into it is a simple rename.
+    """
+    global trash_bin
+
+    delivery_folder = config_settings['CMS']['delivery_folder']
+    trash_settings = config_settings.get('Trash') or {}
+
+    trash_bin = Trash.TrashBin(trash_settings.get('trash_folder', delivery_folder + '\\.trash'),
+                               trash_settings.get('grace_period_hours', 72),
+                               trash_settings.get('reap_workers', 4),
+                               trash_settings.get('reap_rate', 2.0),
+                               logger)
+
+    logger.info('Trash folder:%s; Grace period (hours):%s' % (trash_bin.get_trash_folder(), trash_bin.get_grace_period_hours()))
+
+    # Check the volume once, before any version is processed, rather than failing on the first rename.
+    # A dry run changes nothing, so it checks the nearest existing parent instead of creating the folder.
+    trash_folder = trash_bin.get_trash_folder()
+
+    if activate:
+        os.makedirs(trash_folder, exist_ok=True)
+    else:
+        while not os.path.exists(trash_folder) and os.path.dirname(trash_folder) != trash_folder:
+            trash_folder = os.path.dirname(trash_folder)
+
+    if os.stat(trash_folder).st_dev != os.stat(delivery_folder).st_dev:
+        logger.error('The trash folder must be on the same volume as the delivery folder. Trash folder:%s' % trash_bin.get_trash_folder())
+        raise Exception('The trash folder must be on the same volume as the delivery folder.')
+
+def init_archive_store():
+    """
+    Sets up the content-addressed archive store.
+    """
+    global archive_store
+
+    delivery_folder = config_settings['CMS']['delivery_folder']
+    archive_settings = config_settings.get('Archive') or {}
+
+    archive_store = Store.ArchiveStore(archive_settings.get('store_folder', os.path.dirname(delivery_folder) + '\\DMTArchive'),
+                                       archive_settings.get('chunk_size_mb', 4) * 1024 * 1024,
+                                       archive_settings.get('ingest_workers', 4),
+                                       archive_settings.get('compress_level', 6),
+                                       logger)
+
+    logger.info('Archive store folder:%s' % archive_store.get_store_folder())
+
+def is_maintenance_run():
+    """
+    True when the run only restores or removes trashed/archived versions, without processing deliveries.
+    The -archive_gc argument only runs on its own when no delivery action (-drop, -archive, -cas_archive) was given.
+    """
+    return len(restore_id) > 0 or len(restore_version) > 0 or len(forget_version) > 0 or (archive_gc and not activate)
+
+def run_maintenance():
+    """
+    Returns False when any of the requested operations failed.
+    """
+    success = True
+
+    if len(restore_id) > 0:
+        # A version deleted by the CLI is no longer known to DMT, so its files are never put
+        # back in the delivery folder, where nothing would ever clean them up.
+        delivery_folder = os.path.normcase(os.path.abspath(config_settings['CMS']['delivery_folder']))
+        target_folder = os.path.normcase(os.path.abspath(restore_to))
+
+        if os.path.commonpath([delivery_folder, target_folder]) == delivery_folder:
+            logger.error('The -restore_to folder must be outside the delivery folder:%s' % restore_to)
+            return False
+
+        init_trash()
+
+        try:
+            success = trash_bin.restore(restore_id, restore_to) and success
+        except OSError as exc:
+            logger.error('Unable to restore trash entry:%s; Error:%s' % (restore_id, exc))
+            success = False
+
+    if len(restore_version) > 0 or len(forget_version) > 0 or archive_gc:
+        init_archive_store()
+
+        if len(restore_version) > 0:
+            success = archive_store.restore(app_name, restore_version) and success
+        if len(forget_version) > 0:
+            success = archive_store.forget(app_name, forget_version) and success
+        if archive_gc:
+            success = archive_store.gc() >= 0 and success
+
+    return success
+
+def get_version_folder(app_uuid, ver_uuid):
+    return config_settings['CMS']['delivery_folder'] + '\\data\\{' + app_uuid + '}\\' + ver_uuid
+
 def cleanup_deliveries(app_name, profile_name, dmt_info, log_folder):
     """
     Deletes the deliveries for the given app.
@@ -403,6 +521,38 @@ def cleanup_deliveries(app_name, profile_name, dmt_info, log_folder):
         #TODO - MSH implemented workaround to check if version is empty then done run the exec command.
         if (not activate or version.get_name() == ''):
             logger.info(msg.format(app_name, version_name, version.get_date(),'Archive' if archive_delivery else 'Delete', 'processed' ))
+            continue
+
+        version_folder = get_version_folder(dmt_info.get_uuid(), version.get_uuid())
+
+        # Never purge a version whose source did not make it into the archive store.
+        if cas_archive and not archive_store.ingest(version_folder, app_name, dmt_info.get_uuid(), version.get_name(), version.get_uuid()):
+            logger.error('Version was not archived, skipping purge. App:%s; Version:%s' % (app_name, version.get_name()))
+            continue
+
+        if trash_delivery:
+            # Move the source out of the way first, so the CLI has nothing left to delete.
+            # If the CLI fails, put the source back.
+            # A failed move (e.g. a file locked by an antivirus or indexer) falls back to
+            # the CLI deleting the folder in line, rather than aborting the run.
+            try:
+                trash_id = trash_bin.move_to_trash(version_folder, app_name, version.get_name())
+            except OSError as exc:
+                logger.warning('Unable to move version to trash, it will be deleted in line. App:%s; Version:%s; Error:%s' % (app_name, version.get_name(), exc))
+                trash_id = ''
+
+            if not exec_cli(cli_command) and trash_id != '':
+                restored = False
+
+                try:
+                    restored = trash_bin.restore(trash_id)
+                except OSError as exc:
+                    logger.error('Unable to restore version from trash. Error:%s' % exc)
+
+                if not restored:
+                    # The version is still registered in DMT, but its source will be reaped after the grace period.
+                    logger.error('MANUAL RESTORE NEEDED - the CLI failed and the version source is still in the trash. App:%s; Version:%s; Trash id:%s; Path:%s' %
+                        (app_name, version.get_name(), trash_id, version_folder))
         else:
             #logger.info('MSH CLI COMMAND :%s' % cli_command)
             exec_cli(cli_command)
@@ -422,6 +572,9 @@ def exec_cli(cli):
         cli_cmd.check_returncode()
     except CalledProcessError as exc:
         logger.error('An error occurred while executing CLI:%d. CLI:%s' % (exc.returncode, exc.cmd))
+        return False
+
+    return True
         
 def main():
     global base_url, domain, username, password, CAST_HOME
@@ -449,6 +602,25 @@ def main():
         fhandler.setFormatter(formatter)
         logger.addHandler(fhandler)
 
+        # Restore or remove trashed/archived versions and stop.
+        if is_maintenance_run():
+            if not run_maintenance():
+                sys.exit(1)
+            return
+
+        if cas_archive:
+            init_archive_store()
+
+        # Reap expired trash in the background, while the deliveries are processed.
+        # A dry run only lists what would be reaped.
+        if trash_delivery:
+            init_trash()
+            if activate:
+                trash_bin.start_reaper()
+            else:
+                for entry in trash_bin.get_expired_entries():
+                    logger.info('Trash entry:%s; App:%s; Version:%s; Trashed at:%s would be reaped' % (entry['trash_id'], entry['app_name'], entry['version_name'], entry['trashed_at']))
+
         # Read the CAST-MS conection profile file to retrieve profile names.
         read_pmx(connection_profiles)
 
@@ -494,8 +666,23 @@ def main():
                 else:
                     logger.warning('A CMS profile entry was not found for app:%s.. Skipping' % app['name'])
 
+        if trash_delivery:
+            trash_bin.stop_reaper()
+
+        if archive_gc:
+            if archive_store is None:
+                init_archive_store()
+            archive_store.gc()
+
+    except SystemExit:
+        raise
     except BaseException as ex:
         logger.error('Aborting due to a prior exception. %s' % (str(ex)) )
+
+        # Let deletions in progress finish before exiting.
+        if trash_bin is not None:
+            trash_bin.stop_reaper()
+
         sys.exit(6)
 
 # Start here
@@ -520,6 +707,37 @@ if __name__ == "__main__":
                 logger.info('The -archivre argurment activated. Only delivery source will be rmoved, no deliveries will be deleted.')
                 activate = True
                 archive_delivery = True
+            elif (arg == '-cas_archive'):
+                logger.info('The -cas_archive argument activated. Delivery source will be moved to the archive store, no deliveries will be deleted.')
+                activate = True
+                archive_delivery = True
+                cas_archive = True
+            elif (arg == '-archive_gc'):
+                archive_gc = True
+            elif (arg in ('-restore_version', '-forget_version')):
+                if (count <= index + 1):
+                    logger.error('The argument %s needs to provide a version name' % arg)
+                    sys.exit(1)
+                index += 1
+                if (arg == '-restore_version'):
+                    restore_version = args[index]
+                else:
+                    forget_version = args[index]
+            elif (arg == '-trash'):
+                logger.info('The -trash argument activated. Version source will be moved to the trash folder and reaped in the background.')
+                trash_delivery = True
+            elif (arg == '-restore'):
+                if (count <= index + 1):
+                    logger.error('The argument -restore needs to provide a trash id')
+                    sys.exit(1)
+                index += 1
+                restore_id = args[index]
+            elif (arg == '-restore_to'):
+                if (count <= index + 1):
+                    logger.error('The argument -restore_to needs to provide a folder')
+                    sys.exit(1)
+                index += 1
+                restore_to = args[index]
             elif (arg == '-cut_date'):
                 if (count <= index + 1):
                     logger.error('The arugument -cut_date needs to provide a value')
@@ -538,6 +756,16 @@ if __name__ == "__main__":
                     index += 1
                     app_name = args[index]
                     logger.info('-app flag found, only deliveries for ' + app_name + ' will be deleted.')
+        if (len(restore_id) > 0 and len(restore_to) == 0):
+            logger.error('The -restore argument needs the -restore_to argument')
+            sys.exit(1)
+        if (trash_delivery and archive_delivery):
+            # A purged version stays registered in DMT, so its folder must stay in place.
+            logger.error('The -trash argument cannot be used with -archive or -cas_archive')
+            sys.exit(1)
+        if ((len(restore_version) > 0 or len(forget_version) > 0) and len(app_name) == 0):
+            logger.error('The -restore_version and -forget_version arguments need the -app argument')
+            sys.exit(1)
         if activate:
             run_type = 'ACTIVE'
         else:
@@ -551,8 +779,11 @@ if __name__ == "__main__":
         else:
             op_str = 'deleted'
     
-        logger.info('%s run - all deliveries for %s applications with a date earlier than %s will be %s' % (run_type, app_str, cut_date, op_str))
-        if not activate:
+        if is_maintenance_run():
+            logger.info('Maintenance run - no deliveries will be processed')
+        else:
+            logger.info('%s run - all deliveries for %s applications with a date earlier than %s will be %s' % (run_type, app_str, cut_date, op_str))
+        if not activate and not is_maintenance_run():
             logger.info('No actions will be performed unless the -drop parameter argument is used')
 
     else:
@@ -0,0 +1,379 @@
+"""
+Content-addressed archive store for delivery versions.
+
+Files are split into fixed size chunks, each chunk is stored once, zlib compressed,
+under its SHA-256 hash. Consecutive deliveries share most of their files, so most
+chunks of a new version are already in the store. Each archived version gets a
+JSON manifest listing its files and their chunks, from which it can be restored.
+
+Layout:
+    <store_folder>/chunks/<first 2 chars of hash>/<hash>
+    <store_folder>/manifests/<app uuid>/<version uuid>.json
+"""
+
+import os
+import json
+import hashlib
+import logging
+import shutil
+import time
+import uuid
+import zlib
+
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOCK_FILE = 'store.lock'
+
+class ArchiveStore:
+    def __init__(self, store_folder = '', chunk_size = 4 * 1024 * 1024, ingest_workers = 4, compress_level = 6, logger = None, lock_timeout = 600):
+        self.store_folder = store_folder
+        self.chunk_size = chunk_size
+        self.ingest_workers = ingest_workers
+        self.compress_level = compress_level
+        self.lock_timeout = lock_timeout
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.chunk_folder = os.path.join(store_folder, 'chunks')
+        self.manifest_folder = os.path.join(store_folder, 'manifests')
+
+    def get_store_folder(self):
+        return self.store_folder
+
+    def get_chunk_size(self):
+        return self.chunk_size
+
+    def set_chunk_size(self, chunk_size):
+        self.chunk_size = chunk_size
+
+    def ingest(self, source_folder, app_name, app_uuid, version_name, version_uuid):
+        """
+        Stores the content of source_folder and writes the version manifest.
+        Files are ingested in parallel. Returns True once the manifest is written.
+        A version that is already archived is never ingested again, since its folder
+        may since have been purged.
+        """
+        lock = self._lock()
+
+        if lock is None:
+            self.logger.error('Archive store is locked by another run, version not archived. App:%s; Version:%s' % (app_name, version_name))
+            return False
+
+        try:
+            return self._ingest(source_folder, app_name, app_uuid, version_name, version_uuid)
+        finally:
+            self._unlock(lock)
+
+    def _ingest(self, source_folder, app_name, app_uuid, version_name, version_uuid):
+        if os.path.exists(self._manifest_file(app_uuid, version_uuid)):
+            self.logger.info('Already archived - App:%s; Version:%s' % (app_name, version_name))
+            return True
+
+        if not os.path.isdir(source_folder):
+            self.logger.warning('Nothing to archive, folder does not exist:%s' % source_folder)
+            return False
+
+        folders = []
+        files = []
+
+        for root, dir_names, file_names in os.walk(source_folder):
+            rel_root = os.path.relpath(root, source_folder)
+
+            if rel_root != '.' and len(dir_names) == 0 and len(file_names) == 0:
+                folders.append(_to_manifest_path(rel_root))
+
+            for file_name in file_names:
+                files.append(os.path.join(root, file_name))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.ingest_workers) as executor:
+                file_entries = list(executor.map(self._ingest_file, files))
+        except OSError as exc:
+            self.logger.error('Unable to archive folder:%s; Error:%s' % (source_folder, exc))
+            return False
+
+        for file_entry, file_path in zip(file_entries, files):
+            file_entry['path'] = _to_manifest_path(os.path.relpath(file_path, source_folder))
+
+        manifest = {'app_name': app_name,
+                    'app_uuid': app_uuid,
+                    'version_name': version_name,
+                    'version_uuid': version_uuid,
+                    'original_path': source_folder,
+                    'archived_at': datetime.now().strftime(DATE_FORMAT),
+                    'chunk_size': self.chunk_size,
+                    'folders': folders,
+                    'files': file_entries}
+
+        self._write_manifest(app_uuid, version_uuid, manifest)
+
+        total_size = sum(file_entry['size'] for file_entry in file_entries)
+        self.logger.info('Archived - App:%s; Version:%s; Files:%d; Size:%d bytes' % (app_name, version_name, len(file_entries), total_size))
+
+        return True
+
+    def restore(self, app_name, version_name, target_folder = ''):
+        """
+        Rebuilds an archived version, by default in its original location.
+        Each restored file is checked against the hash recorded in the manifest.
+        """
+        manifest = self.find_manifest(app_name, version_name)
+
+        if manifest is None:
+            self.logger.error('No archive found for App:%s; Version:%s' % (app_name, version_name))
+            return False
+
+        if target_folder == '':
+            target_folder = manifest['original_path']
+
+        if os.path.exists(target_folder):
+            self.logger.error('Cannot restore, the target folder already exists:%s' % target_folder)
+            return False
+
+        # Rebuild next to the target and move it into place only once every file checks out,
+        # so a failed restore leaves nothing behind and can simply be retried.
+        temp_folder = target_folder + '.' + uuid.uuid4().hex + '.restoring'
+
+        try:
+            self._restore_files(manifest, temp_folder)
+            os.rename(temp_folder, target_folder)
+        except (OSError, ValueError, zlib.error) as exc:
+            self.logger.error('Unable to restore App:%s; Version:%s; Error:%s' % (app_name, version_name, exc))
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            return False
+
+        self.logger.info('Restored - App:%s; Version:%s; Path:%s' % (app_name, version_name, target_folder))
+
+        return True
+
+    def forget(self, app_name, version_name):
+        """
+        Removes a version's manifest. Its chunks are released by the next gc().
+        """
+        manifest_file = self._find_manifest_file(app_name, version_name)
+
+        if manifest_file == '':
+            self.logger.error('No archive found for App:%s; Version:%s' % (app_name, version_name))
+            return False
+
+        os.remove(manifest_file)
+        self.logger.info('Removed archive - App:%s; Version:%s' % (app_name, version_name))
+
+        return True
+
+    def gc(self):
+        """
+        Deletes chunks no longer referenced by any manifest.
+        Returns the number of chunks removed, or -1 when the store is locked by another run.
+        """
+        lock = self._lock()
+
+        if lock is None:
+            self.logger.error('Archive store is locked by another run, gc skipped')
+            return -1
+
+        try:
+            return self._gc()
+        finally:
+            self._unlock(lock)
+
+    def _gc(self):
+        referenced = set()
+
+        for manifest_file in self._list_manifest_files():
+            for file_entry in self._read_manifest(manifest_file)['files']:
+                referenced.update(file_entry['chunks'])
+
+        removed = 0
+        freed = 0
+
+        if not os.path.isdir(self.chunk_folder):
+            return removed
+
+        for prefix in os.listdir(self.chunk_folder):
+            prefix_folder = os.path.join(self.chunk_folder, prefix)
+
+            for chunk_name in os.listdir(prefix_folder):
+                # Left over temp files from an interrupted ingest are never referenced either.
+                if chunk_name not in referenced:
+                    chunk_file = os.path.join(prefix_folder, chunk_name)
+                    freed += os.path.getsize(chunk_file)
+                    os.remove(chunk_file)
+                    removed += 1
+
+        self.logger.info('Archive gc removed %d chunks, %d bytes freed' % (removed, freed))
+
+        return removed
+
+    def find_manifest(self, app_name, version_name):
+        manifest_file = self._find_manifest_file(app_name, version_name)
+
+        if manifest_file == '':
+            return None
+
+        return self._read_manifest(manifest_file)
+
+    def _find_manifest_file(self, app_name, version_name):
+        for manifest_file in self._list_manifest_files():
+            manifest = self._read_manifest(manifest_file)
+
+            if manifest['app_name'].lower() == app_name.lower() and manifest['version_name'] == version_name:
+                return manifest_file
+
+        return ''
+
+    def _list_manifest_files(self):
+        manifest_files = []
+
+        if not os.path.isdir(self.manifest_folder):
+            return manifest_files
+
+        for app_uuid in os.listdir(self.manifest_folder):
+            app_folder = os.path.join(self.manifest_folder, app_uuid)
+
+            for file_name in os.listdir(app_folder):
+                if file_name.endswith('.json'):
+                    manifest_files.append(os.path.join(app_folder, file_name))
+
+        return manifest_files
+
+    def _ingest_file(self, file_path):
+        file_hash = hashlib.sha256()
+        chunks = []
+        size = 0
+
+        with open(file_path, 'rb') as f:
+            while True:
+                data = f.read(self.chunk_size)
+
+                if not data:
+                    break
+
+                file_hash.update(data)
+                chunks.append(self._write_chunk(data))
+                size += len(data)
+
+        return {'size': size, 'sha256': file_hash.hexdigest(), 'chunks': chunks}
+
+    def _restore_files(self, manifest, target_folder):
+        os.makedirs(target_folder)
+
+        for folder in manifest['folders']:
+            os.makedirs(os.path.join(target_folder, *folder.split('/')), exist_ok=True)
+
+        for file_entry in manifest['files']:
+            file_path = os.path.join(target_folder, *file_entry['path'].split('/'))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+            file_hash = hashlib.sha256()
+
+            with open(file_path, 'wb') as f:
+                for chunk_hash in file_entry['chunks']:
+                    data = self._read_chunk(chunk_hash)
+                    file_hash.update(data)
+                    f.write(data)
+
+            if file_hash.hexdigest() != file_entry['sha256']:
+                raise ValueError('Restored file does not match the archive, store may be damaged:%s' % file_entry['path'])
+
+    def _lock(self):
+        """
+        Takes the exclusive store lock, so ingest() and gc() never overlap, even across runs.
+        The lock is held on an open file, so the OS releases it if the run dies.
+        Returns the lock file, or None when the lock could not be taken within lock_timeout seconds.
+        """
+        os.makedirs(self.store_folder, exist_ok=True)
+
+        lock_file = open(os.path.join(self.store_folder, LOCK_FILE), 'a+')
+        deadline = time.time() + self.lock_timeout
+
+        while True:
+            try:
+                if msvcrt:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+                return lock_file
+            except OSError:
+                if time.time() >= deadline:
+                    lock_file.close()
+                    return None
+
+                self.logger.debug('Waiting for the archive store lock')
+                time.sleep(1)
+
+    def _unlock(self, lock_file):
+        if msvcrt:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+        lock_file.close()
+
+    def _chunk_file(self, chunk_hash):
+        return os.path.join(self.chunk_folder, chunk_hash[:2], chunk_hash)
+
+    def _write_chunk(self, data):
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        chunk_file = self._chunk_file(chunk_hash)
+
+        if os.path.exists(chunk_file):
+            if self._chunk_is_valid(chunk_hash):
+                return chunk_hash
+
+            # We have the data at hand, so repair the damaged chunk rather than point at it.
+            self.logger.warning('Damaged chunk found in the archive store, rewriting it:%s' % chunk_file)
+
+        os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+
+        # Write to a temp file and rename, so a chunk is either complete or absent,
+        # even when two workers store the same chunk at once.
+        temp_file = chunk_file + '.' + uuid.uuid4().hex + '.tmp'
+
+        with open(temp_file, 'wb') as f:
+            f.write(zlib.compress(data, self.compress_level))
+
+        os.replace(temp_file, chunk_file)
+
+        return chunk_hash
+
+    def _chunk_is_valid(self, chunk_hash):
+        try:
+            return hashlib.sha256(self._read_chunk(chunk_hash)).hexdigest() == chunk_hash
+        except (OSError, zlib.error):
+            return False
+
+    def _read_chunk(self, chunk_hash):
+        with open(self._chunk_file(chunk_hash), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def _manifest_file(self, app_uuid, version_uuid):
+        return os.path.join(self.manifest_folder, app_uuid, version_uuid + '.json')
+
+    def _write_manifest(self, app_uuid, version_uuid, manifest):
+        manifest_file = self._manifest_file(app_uuid, version_uuid)
+        os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+
+        temp_file = manifest_file + '.tmp'
+
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        os.replace(temp_file, manifest_file)
+
+    def _read_manifest(self, manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)
+
+def _to_manifest_path(rel_path):
+    # Manifests always use forward slashes, whatever the platform.
+    return rel_path.replace(os.sep, '/')
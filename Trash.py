@@ -0,0 +1,282 @@
+"""
+Trash area for delivery versions.
+
+Instead of deleting a version's source tree in line, the tree is renamed into a
+.trash folder on the same volume (a near instant operation) and a background
+reaper physically deletes it later. Each trashed entry carries a small JSON
+manifest, so the trash survives restarts and an entry can be restored to its
+original location until its grace period expires.
+"""
+
+import os
+import json
+import stat
+import shutil
+import logging
+import threading
+import uuid
+
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_FILE = 'trash.json'
+PAYLOAD_FOLDER = 'payload'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class TrashBin:
+    def __init__(self, trash_folder = '', grace_period_hours = 72, reap_workers = 4, reap_rate = 2.0, logger = None):
+        self.trash_folder = trash_folder
+        self.grace_period_hours = grace_period_hours
+        self.reap_workers = reap_workers
+        self.reap_rate = reap_rate
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.reaper = None
+        self.stop_event = threading.Event()
+
+    def get_trash_folder(self):
+        return self.trash_folder
+
+    def set_trash_folder(self, trash_folder):
+        self.trash_folder = trash_folder
+
+    def get_grace_period_hours(self):
+        return self.grace_period_hours
+
+    def set_grace_period_hours(self, grace_period_hours):
+        self.grace_period_hours = grace_period_hours
+
+    def move_to_trash(self, path, app_name = '', version_name = ''):
+        """
+        Logically removes the given folder by renaming it into the trash area.
+        Returns the trash id, or '' when there was nothing to move.
+        """
+        if not os.path.exists(path):
+            self.logger.warning('Nothing to trash, folder does not exist:%s' % path)
+            return ''
+
+        trash_id = datetime.now().strftime('%Y%m%d%H%M%S') + '_' + uuid.uuid4().hex[:8]
+        entry_folder = os.path.join(self.trash_folder, trash_id)
+
+        os.makedirs(entry_folder)
+
+        # The manifest is written before the rename. If the run dies in between,
+        # the reaper finds an entry without a payload and simply removes it.
+        self._write_manifest(entry_folder, {'trash_id': trash_id,
+                                            'original_path': path,
+                                            'app_name': app_name,
+                                            'version_name': version_name,
+                                            'trashed_at': datetime.now().strftime(DATE_FORMAT)})
+
+        try:
+            os.rename(path, os.path.join(entry_folder, PAYLOAD_FOLDER))
+        except OSError as exc:
+            self.logger.error('Unable to move folder to trash. Folder:%s; Error:%s' % (path, exc))
+            shutil.rmtree(entry_folder, ignore_errors=True)
+            raise
+
+        self.logger.info('Moved to trash - App:%s; Version:%s; Trash id:%s' % (app_name, version_name, trash_id))
+
+        return trash_id
+
+    def restore(self, trash_id, target_folder = ''):
+        """
+        Moves a trashed payload back to its original location, or to target_folder when given.
+        The target folder may be on another volume, in which case the payload is copied.
+        """
+        entry_folder = os.path.join(self.trash_folder, trash_id)
+        manifest = self._read_manifest(entry_folder)
+
+        if manifest is None:
+            self.logger.error('Trash entry not found:%s' % trash_id)
+            return False
+
+        payload = os.path.join(entry_folder, PAYLOAD_FOLDER)
+        original_path = target_folder if target_folder != '' else manifest['original_path']
+
+        if not os.path.exists(payload):
+            self.logger.error('Trash entry has no payload, it cannot be restored:%s' % trash_id)
+            return False
+
+        if os.path.exists(original_path):
+            self.logger.error('Cannot restore, the target location already exists:%s' % original_path)
+            return False
+
+        if target_folder != '':
+            shutil.move(payload, original_path)
+        else:
+            os.rename(payload, original_path)
+        shutil.rmtree(entry_folder, ignore_errors=True)
+
+        self.logger.info('Restored from trash - App:%s; Version:%s; Path:%s' % (manifest['app_name'], manifest['version_name'], original_path))
+
+        return True
+
+    def list_entries(self):
+        """
+        Returns the manifests of all entries currently in the trash, oldest first.
+        """
+        entries = []
+
+        if not os.path.isdir(self.trash_folder):
+            return entries
+
+        for trash_id in sorted(os.listdir(self.trash_folder)):
+            entry_folder = os.path.join(self.trash_folder, trash_id)
+
+            if not os.path.isdir(entry_folder):
+                continue
+
+            manifest = self._read_manifest(entry_folder)
+
+            if manifest is None:
+                if os.path.exists(os.path.join(entry_folder, PAYLOAD_FOLDER)):
+                    # Without a manifest, neither the grace period nor the original location is known.
+                    self.logger.warning('Trash entry has a payload but no readable manifest, leaving it alone:%s' % entry_folder)
+                    continue
+
+                # Left over from an interrupted move or reap.
+                manifest = {'trash_id': trash_id, 'original_path': '', 'app_name': '', 'version_name': '', 'trashed_at': ''}
+
+            entries.append(manifest)
+
+        return entries
+
+    def get_expired_entries(self):
+        cut_off = datetime.now() - timedelta(hours=self.grace_period_hours)
+        expired = []
+
+        for entry in self.list_entries():
+            if entry['trashed_at'] == '':
+                expired.append(entry)
+                continue
+
+            try:
+                trashed_at = datetime.strptime(entry['trashed_at'], DATE_FORMAT)
+            except ValueError:
+                self.logger.warning('Trash entry has an invalid date, leaving it alone:%s' % entry['trash_id'])
+                continue
+
+            if trashed_at < cut_off:
+                expired.append(entry)
+
+        return expired
+
+    def start_reaper(self):
+        """
+        Starts deleting expired trash entries on a background thread.
+        """
+        self.stop_event.clear()
+        self.reaper = threading.Thread(target=self.reap, name='TrashReaper', daemon=True)
+        self.reaper.start()
+
+    def stop_reaper(self):
+        """
+        Stops the reaper from starting new deletions and waits for the ones in progress.
+        Entries not reaped yet are picked up by the next run.
+        """
+        if self.reaper is not None:
+            self.stop_event.set()
+            self.reaper.join()
+            self.reaper = None
+
+    def reap(self):
+        """
+        Physically deletes expired trash entries in parallel.
+        At most reap_workers deletions are in progress at a time, and they are started
+        at no more than reap_rate entries per second. Once the reaper is stopped, no new
+        deletion is started; the ones in progress are allowed to finish.
+        """
+        # Runs on the reaper thread, where an uncaught error would only reach stderr.
+        try:
+            return self._reap()
+        except Exception as exc:
+            self.logger.error('Trash reaper stopped on an error. Remaining entries are picked up by the next run. Error:%s' % exc)
+            return 0
+
+    def _reap(self):
+        expired = self.get_expired_entries()
+
+        if len(expired) == 0:
+            self.logger.debug('Nothing to reap in trash folder:%s' % self.trash_folder)
+            return 0
+
+        self.logger.info('Reaping %d trash entries' % len(expired))
+
+        interval = 1.0 / self.reap_rate if self.reap_rate > 0 else 0
+        slots = threading.Semaphore(self.reap_workers)
+        futures = []
+
+        with ThreadPoolExecutor(max_workers=self.reap_workers) as executor:
+            for entry in expired:
+                # Only submit once a worker is free, so nothing piles up in the executor queue.
+                while not slots.acquire(timeout=0.5):
+                    if self.stop_event.is_set():
+                        break
+
+                if self.stop_event.is_set():
+                    break
+
+                future = executor.submit(self._reap_entry, entry['trash_id'])
+                future.add_done_callback(lambda f: slots.release())
+                futures.append(future)
+
+                if interval:
+                    self.stop_event.wait(interval)
+
+            for future in futures:
+                future.cancel()
+
+        reaped = sum(1 for future in futures if not future.cancelled() and future.result())
+
+        self.logger.info('Reaped %d of %d trash entries' % (reaped, len(expired)))
+
+        return reaped
+
+    def _reap_entry(self, trash_id):
+        entry_folder = os.path.join(self.trash_folder, trash_id)
+
+        try:
+            # Payload first, so a reap interrupted half way still has its manifest
+            # and is retried on the next run.
+            shutil.rmtree(os.path.join(entry_folder, PAYLOAD_FOLDER), onerror=_remove_readonly)
+            shutil.rmtree(entry_folder, onerror=_remove_readonly)
+        except OSError as exc:
+            self.logger.error('Unable to reap trash entry:%s; Error:%s' % (trash_id, exc))
+            return False
+
+        self.logger.debug('Reaped trash entry:%s' % trash_id)
+
+        return True
+
+    def _write_manifest(self, entry_folder, manifest):
+        manifest_file = os.path.join(entry_folder, MANIFEST_FILE)
+        temp_file = manifest_file + '.tmp'
+
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        os.replace(temp_file, manifest_file)
+
+    def _read_manifest(self, entry_folder):
+        manifest_file = os.path.join(entry_folder, MANIFEST_FILE)
+
+        if not os.path.exists(manifest_file):
+            return None
+
+        try:
+            with open(manifest_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as exc:
+            self.logger.warning('Invalid trash manifest:%s; Error:%s' % (manifest_file, exc))
+            return None
+
+def _remove_readonly(func, path, exc_info):
+    """
+    shutil.rmtree error handler. Source files checked out from SCM are often read-only,
+    which blocks deletion on Windows.
+    """
+    if not os.path.exists(path):
+        return
+
+    os.chmod(path, stat.S_IWRITE)
+    func(path)